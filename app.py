@@ -6,98 +6,197 @@ Production-ready Flask application for sending bulk SMS via Twilio
 
 import os
 import csv
+import io
 import json
+import gzip
+import atexit
+import itertools
 import logging
+import logging.handlers
+import queue
 from datetime import datetime, timedelta
 from functools import wraps
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
-import sqlite3
+import threading
 from threading import Thread
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import time
 
-from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify
+import click
+from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, Response
 from twilio.rest import Client
 from twilio.base.exceptions import TwilioException
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('twilio_sms.log'),
-        logging.StreamHandler()
-    ]
-)
+from storage import create_storage
+from messaging import (PRIORITY_WEIGHTS, SIMULATED_LATENCY, SIMULATED_LATENCY_JITTER, SIMULATED_ERROR_RATE,
+                       AccountQueue, CampaignJob, TransientError, compile_message_template,
+                       normalize_column_name, simulate_campaign)
+from profiling import init_profiling, profile_phase
+
+# Logging configuration (see .env.example)
+LOG_FILE = os.environ.get('LOG_FILE', 'twilio_sms.log')
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+LOG_MAX_BYTES = int(os.environ.get('LOG_MAX_BYTES', 10 * 1024 * 1024))
+LOG_BACKUP_COUNT = int(os.environ.get('LOG_BACKUP_COUNT', 5))
+LOG_ROTATE_WHEN = os.environ.get('LOG_ROTATE_WHEN', '')  # e.g. 'midnight' for time-based rotation
+LOG_SUCCESS_EVERY = max(1, int(os.environ.get('LOG_SUCCESS_EVERY', 100)))
+
+# Attributes every LogRecord has; anything else was passed via extra=
+LOG_RECORD_ATTRS = frozenset(vars(logging.makeLogRecord({}))) | {'message', 'asctime'}
+
+class JsonFormatter(logging.Formatter):
+    """Format log records as one JSON object per line"""
+    
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in LOG_RECORD_ATTRS:
+                entry[key] = value
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+def open_log_file(watched=False):
+    """File handler for LOG_FILE that rotates it in-process, or only reopens it
+    
+    A rotating handler is only safe while a single process owns the file. With
+    ``watched`` the file is reopened whenever an external tool such as
+    logrotate has moved it, so several processes can share it.
+    """
+    if watched:
+        handler = logging.handlers.WatchedFileHandler(LOG_FILE)
+    elif LOG_ROTATE_WHEN:
+        handler = logging.handlers.TimedRotatingFileHandler(
+            LOG_FILE, when=LOG_ROTATE_WHEN, backupCount=LOG_BACKUP_COUNT)
+    else:
+        handler = logging.handlers.RotatingFileHandler(
+            LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT)
+    handler.setFormatter(JsonFormatter())
+    return handler
+
+class LogWriter:
+    """Background thread writing queued log records to the log file and stderr
+    
+    Callers only pay for putting the record on the queue; formatting and file
+    I/O happen on the QueueListener thread. The app rotates its own log file
+    until the process forks (gunicorn preloads the app, then forks workers);
+    from then on every process writes through a WatchedFileHandler and
+    rotation is left to logrotate, so no two processes rotate the same file.
+    """
+    
+    def __init__(self):
+        self.queue_handler = logging.handlers.QueueHandler(queue.SimpleQueue())
+        self.queue_handler.setFormatter(logging.Formatter('%(message)s'))
+        self.stream_handler = logging.StreamHandler()
+        self.stream_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+        self.file_handler = open_log_file()
+        self.listener = None
+    
+    def start(self):
+        self.listener = logging.handlers.QueueListener(
+            self.queue_handler.queue, self.file_handler, self.stream_handler, respect_handler_level=True)
+        self.listener.start()
+    
+    def stop(self):
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+    
+    def after_fork_in_parent(self):
+        if not isinstance(self.file_handler, logging.handlers.WatchedFileHandler):
+            self.stop()
+            self.file_handler.close()
+            self.file_handler = open_log_file(watched=True)
+            self.start()
+    
+    def after_fork_in_child(self):
+        # The parent's listener thread does not exist here; records already
+        # queued belong to the parent, so start over with a fresh queue
+        self.listener = None
+        self.queue_handler.queue = queue.SimpleQueue()
+        self.file_handler.close()
+        self.file_handler = open_log_file(watched=True)
+        self.start()
+
+def setup_logging():
+    """Route log records through a queue to a background writer thread"""
+    writer = LogWriter()
+    logging.basicConfig(level=LOG_LEVEL, handlers=[writer.queue_handler])
+    writer.start()
+    atexit.register(writer.stop)
+    
+    if hasattr(os, 'register_at_fork'):
+        os.register_at_fork(after_in_parent=writer.after_fork_in_parent,
+                            after_in_child=writer.after_fork_in_child)
+    
+    return writer
+
+log_writer = setup_logging()
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY', 'your-secret-key-change-in-production')
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 app.config['UPLOAD_FOLDER'] = 'uploads'
+# Relative to the application directory, so archives are found from any working directory
+app.config['ARCHIVE_FOLDER'] = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                            os.environ.get('ARCHIVE_FOLDER', 'archive'))
+
+# Persistent state; DATABASE_URL selects SQLite (default) or PostgreSQL
+storage = create_storage(os.environ.get('DATABASE_URL', 'sqlite:///twilio_sms.db'),
+                         int(os.environ.get('DATABASE_POOL_SIZE', 10)))
 
 # Ensure upload directory exists
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
+# Opt-in request profiling: phase timings, slow request/query logs, sampled cProfile dumps
+if os.environ.get('PROFILING_ENABLED', '').lower() in ('1', 'true', 'yes'):
+    init_profiling(
+        app, storage,
+        slow_request_ms=float(os.environ.get('SLOW_REQUEST_MS', 500)),
+        slow_query_ms=float(os.environ.get('SLOW_QUERY_MS', 100)),
+        profile_routes=[route.strip() for route in os.environ.get('PROFILE_ROUTES', '').split(',') if route.strip()],
+        profile_sample_rate=float(os.environ.get('PROFILE_SAMPLE_RATE', 0.1)),
+        profile_folder=os.environ.get('PROFILE_FOLDER', 'profiles'),
+        profile_users=[user.strip() for user in os.environ.get('PROFILE_USERS', 'admin').split(',') if user.strip()],
+        max_profiles=int(os.environ.get('PROFILE_MAX_FILES', 100))
+    )
+
+# CSV header names recognised as the recipient phone number column
+PHONE_COLUMNS = ('phone', 'phone_number', 'number', 'mobile', 'to')
+
+# Finished campaigns older than this many days are moved out of message_status
+ARCHIVE_AFTER_DAYS = int(os.environ.get('ARCHIVE_AFTER_DAYS', 90))
+
+# Free pages released per incremental vacuum step after archiving a campaign
+ARCHIVE_VACUUM_PAGES = int(os.environ.get('ARCHIVE_VACUUM_PAGES', 2000))
+
+# Message rows shown on the campaign status page; the export has all of them
+MESSAGE_DISPLAY_LIMIT = int(os.environ.get('MESSAGE_DISPLAY_LIMIT', 1000))
+
+# Recipients read from the database per query while a campaign is sending
+RECIPIENT_CHUNK_SIZE = int(os.environ.get('RECIPIENT_CHUNK_SIZE', 500))
+
+# Uploaded recipients stored per transaction, so an upload never holds the
+# database write lock for long
+RECIPIENT_INSERT_CHUNK_SIZE = int(os.environ.get('RECIPIENT_INSERT_CHUNK_SIZE', 5000))
+
 # Database initialization
 def init_db():
-    """Initialize SQLite database"""
-    conn = sqlite3.connect('twilio_sms.db')
-    cursor = conn.cursor()
-    
-    # Users table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT UNIQUE NOT NULL,
-            password_hash TEXT NOT NULL,
-            twilio_sid TEXT,
-            twilio_token TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    # SMS campaigns table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS campaigns (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            name TEXT NOT NULL,
-            message_body TEXT NOT NULL,
-            total_numbers INTEGER,
-            successful_sends INTEGER DEFAULT 0,
-            failed_sends INTEGER DEFAULT 0,
-            status TEXT DEFAULT 'pending',
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            completed_at TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (id)
-        )
-    ''')
-    
-    # Individual message status table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS message_status (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            campaign_id INTEGER,
-            phone_number TEXT,
-            message_sid TEXT,
-            status TEXT,
-            error_message TEXT,
-            sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (campaign_id) REFERENCES campaigns (id)
-        )
-    ''')
+    """Initialize database schema and default admin user"""
+    storage.init_schema()
     
     # Create default admin user if not exists
-    cursor.execute('SELECT COUNT(*) FROM users WHERE username = ?', ('admin',))
-    if cursor.fetchone()[0] == 0:
-        admin_hash = generate_password_hash('admin123')
-        cursor.execute('INSERT INTO users (username, password_hash) VALUES (?, ?)', 
-                      ('admin', admin_hash))
+    if storage.get_user_by_username('admin') is None:
+        storage.create_user('admin', generate_password_hash('admin123'))
         logger.info("Default admin user created (username: admin, password: admin123)")
-    
-    conn.commit()
-    conn.close()
 
 def login_required(f):
     """Decorator to require login for protected routes"""
@@ -110,14 +209,10 @@ def login_required(f):
 
 def get_user_twilio_client(user_id):
     """Get Twilio client for specific user"""
-    conn = sqlite3.connect('twilio_sms.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT twilio_sid, twilio_token FROM users WHERE id = ?', (user_id,))
-    result = cursor.fetchone()
-    conn.close()
-    
-    if result and result[0] and result[1]:
-        return Client(result[0], result[1])
+    user = storage.get_user(user_id)
+    
+    if user and user[2] and user[3]:
+        return Client(user[2], user[3])
     return None
 
 def parse_phone_numbers(file_path):
@@ -159,72 +254,534 @@ def parse_phone_numbers(file_path):
         logger.error(f"Error parsing phone numbers: {str(e)}")
         return []
 
-def send_bulk_sms_async(campaign_id, phone_numbers, message_body, twilio_client, from_number):
-    """Send bulk SMS asynchronously"""
-    conn = sqlite3.connect('twilio_sms.db')
-    cursor = conn.cursor()
+def parse_recipients(file_path, columns=None):
+    """Parse recipients and their template fields from uploaded file
     
-    successful = 0
-    failed = 0
+    Yields (phone_number, fields) pairs. CSV files whose first row names a
+    phone column are read row by row as records, keeping only the columns
+    listed in ``columns``. Any other file is parsed by parse_phone_numbers and
+    gets empty fields. Duplicate numbers are dropped when stored.
+    """
+    if file_path.endswith('.csv'):
+        with open(file_path, 'r', encoding='utf-8-sig', newline='') as file:
+            csv_reader = csv.reader(file)
+            header = [normalize_column_name(cell) for cell in next(csv_reader, [])]
+            phone_index = next((i for i, name in enumerate(header) if name in PHONE_COLUMNS), None)
+            
+            if phone_index is not None:
+                wanted = [(i, name) for i, name in enumerate(header)
+                          if i != phone_index and (columns is None or name in columns)]
+                for row in csv_reader:
+                    number = row[phone_index].strip() if phone_index < len(row) else ''
+                    if number:
+                        yield number, {name: (row[i].strip() if i < len(row) else '') for i, name in wanted}
+                return
     
-    try:
-        cursor.execute('UPDATE campaigns SET status = ? WHERE id = ?', ('sending', campaign_id))
-        conn.commit()
+    for number in parse_phone_numbers(file_path):
+        yield number, {}
+
+def iter_campaign_messages(campaign_id, render, chunk_size=RECIPIENT_CHUNK_SIZE):
+    """Stream a campaign's pending recipients as (recipient_id, phone_number, body, segments)
+    
+    Rows are read in id-ordered chunks, each as a separate storage query, so
+    memory is bounded by the chunk size rather than the campaign size and the
+    generator can be advanced from any thread. A failed chunk query raises
+    TransientError, so the dispatcher resumes the campaign later.
+    """
+    last_id = 0
+    while True:
+        try:
+            rows = storage.fetch_pending_recipients(campaign_id, last_id, chunk_size)
+        except Exception as e:
+            raise TransientError(f'Failed to read recipients: {str(e)}') from e
+        if not rows:
+            return
+        for recipient_id, phone_number, fields in rows:
+            body, segments = render(json.loads(fields) if fields else {})
+            yield recipient_id, phone_number, body, segments
+        last_id = rows[-1][0]
+
+def store_campaign_recipients(campaign_id, recipients, chunk_size=RECIPIENT_INSERT_CHUNK_SIZE):
+    """Store parsed (phone_number, fields) recipients of a pending campaign
+    
+    Each chunk is parsed before its transaction starts and committed on its
+    own, so parsing never runs while the database is locked for writing, and
+    profiling reports parsing and inserting as separate phases.
+    """
+    while True:
+        with profile_phase('upload_parse'):
+            chunk = [(number, json.dumps(fields) if fields else None)
+                     for number, fields in itertools.islice(recipients, chunk_size)]
+        if not chunk:
+            return
+        storage.add_recipients(campaign_id, chunk)
+
+def parse_rate_overrides(value):
+    """Parse 'ACCOUNT_SID:rate,...' into per-account segments-per-second limits"""
+    rates = {}
+    for item in value.split(','):
+        account_sid, sep, rate = item.partition(':')
+        if sep and account_sid.strip():
+            rates[account_sid.strip()] = float(rate)
+    return rates
+
+# Campaign dispatch: default SMS segments per second per Twilio account, optional
+# per-account overrides ('ACxxx:10,ACyyy:3') and the number of sender threads
+ACCOUNT_MPS = float(os.environ.get('ACCOUNT_MPS', 1))
+ACCOUNT_MPS_OVERRIDES = parse_rate_overrides(os.environ.get('ACCOUNT_MPS_OVERRIDES', ''))
+DISPATCH_WORKERS = int(os.environ.get('DISPATCH_WORKERS', 8))
+
+# Seconds between checks for new campaigns, and between attempts of standby
+# processes to take over dispatching
+DISPATCH_POLL_SECONDS = float(os.environ.get('DISPATCH_POLL_SECONDS', 2))
+
+# Whether web processes run the dispatcher (one of them at a time); turn off
+# when a separate `flask run-dispatcher` process is deployed
+DISPATCHER_IN_WEB = os.environ.get('DISPATCHER_IN_WEB', 'true').lower() in ('1', 'true', 'yes')
+
+# Backoff bounds (seconds) for retrying result writes the database rejected
+DISPATCH_RETRY_MIN = 0.5
+DISPATCH_RETRY_MAX = 30.0
+
+# Longest wait (seconds) at exit for in-flight sends and their results
+DISPATCH_STOP_SECONDS = 30.0
+
+class CampaignDispatcher:
+    """Central sender for all campaigns of the deployment
+    
+    Every process may start a dispatcher, but only the one holding the
+    storage's dispatch lock sends; the others wait to take over if it exits.
+    Campaigns are picked up from storage (status 'sending'), so campaigns left
+    unfinished by a restart are resumed from their pending recipients.
+    
+    A scheduler thread picks messages per Twilio account within that
+    account's rate budget and hands them to a pool of sender threads. Results
+    come back to the scheduler thread, which is the only database writer and
+    batches message_status inserts. A batch the database rejects (e.g. while
+    it is locked) is kept and retried with backoff, and a campaign is only
+    marked finished once all of its results are stored.
+    
+    Recipients are marked 'claimed' before they are handed to a sender. When
+    the process exits, the dispatcher stops picking, waits for the sends in
+    flight and stores their results. After a crash, claimed recipients
+    without a result are sent again on resume, so only messages that were in
+    flight at that moment can be sent twice.
+    """
+    
+    def __init__(self, workers):
+        self.workers = workers
+        self.condition = threading.Condition()
+        self.accounts = {}
+        self.results = []
+        self.finished = []
+        self.claims = []
+        self.in_flight = 0
+        self.retry_at = 0.0
+        self.retry_delay = 0.0
+        self.active = set()
+        self.paused = {}
+        self.poll_requested = False
+        self.stopping = False
+        self.executor = None
+        self.thread = None
+        self.pid = None
+    
+    def start(self):
+        """Start this process's dispatcher thread if it is not running yet"""
+        with self.condition:
+            if self.thread is None or self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.stopping = False
+                self.thread = Thread(target=self.run, name='sms-dispatcher', daemon=True)
+                self.thread.start()
+    
+    def stop(self):
+        """Stop picking messages, wait for the sends in flight and store their results"""
+        with self.condition:
+            if self.thread is None or self.pid != os.getpid():
+                return
+            self.stopping = True
+            self.condition.notify()
+        self.thread.join(DISPATCH_STOP_SECONDS)
+    
+    def wake(self):
+        """Look for new campaigns now instead of at the next poll
+        
+        Web processes only start a dispatcher with DISPATCHER_IN_WEB; otherwise
+        a separate dispatcher process finds the campaign at its next poll.
+        """
+        if DISPATCHER_IN_WEB:
+            self.start()
+        with self.condition:
+            if self.thread is None or self.pid != os.getpid():
+                return
+            self.poll_requested = True
+            self.condition.notify()
+    
+    def load_job(self, campaign_id, user_id, message_body, priority, from_number):
+        """Build the sending state of a stored campaign, counting results already stored"""
+        _, render = compile_message_template(message_body)
+        twilio_client = get_user_twilio_client(user_id)
+        released = storage.release_claimed_recipients(campaign_id)
+        if released:
+            logger.warning(f"Campaign {campaign_id}: sending {released} claimed recipients again, "
+                           f"the previous dispatcher stopped before storing their result",
+                           extra={'campaign_id': campaign_id})
+        job = CampaignJob(campaign_id, user_id, iter_campaign_messages(campaign_id, render),
+                          twilio_client, from_number, priority)
+        job.successful, job.failed, job.total_segments = storage.get_message_totals(campaign_id)
+        
+        if twilio_client is None:
+            job.error = 'Twilio credentials are not configured'
+        elif not from_number:
+            job.error = 'Campaign has no sender number'
+        else:
+            job.advance()
+        
+        if job.successful or job.failed:
+            logger.info(f"Resuming campaign {campaign_id} after {job.successful + job.failed} messages",
+                        extra={'campaign_id': campaign_id})
+        return job
+    
+    def load_campaigns(self):
+        """Add stored campaigns that are waiting to be sent and not running yet"""
+        try:
+            campaigns = storage.list_sending_campaigns()
+        except Exception as e:
+            logger.error(f"Dispatcher failed to list campaigns: {str(e)}")
+            return
         
-        for phone_number in phone_numbers:
+        for row in campaigns:
+            resume_at, _ = self.paused.get(row[0], (0.0, 0.0))
+            if row[0] in self.active or time.monotonic() < resume_at:
+                continue
             try:
-                message = twilio_client.messages.create(
-                    from_=from_number,
-                    body=message_body,
-                    to=phone_number
-                )
-                
-                cursor.execute('''
-                    INSERT INTO message_status (campaign_id, phone_number, message_sid, status)
-                    VALUES (?, ?, ?, ?)
-                ''', (campaign_id, phone_number, message.sid, 'sent'))
-                
-                successful += 1
-                logger.info(f"SMS sent to {phone_number}: {message.sid}")
-                
-                # Small delay to avoid rate limiting
-                time.sleep(1)
-                
-            except TwilioException as e:
-                cursor.execute('''
-                    INSERT INTO message_status (campaign_id, phone_number, message_sid, status, error_message)
-                    VALUES (?, ?, ?, ?, ?)
-                ''', (campaign_id, phone_number, None, 'failed', str(e)))
-                
-                failed += 1
-                logger.error(f"Failed to send SMS to {phone_number}: {str(e)}")
+                job = self.load_job(*row)
+            except Exception as e:
+                logger.error(f"Dispatcher failed to load campaign {row[0]}: {str(e)}", extra={'campaign_id': row[0]})
+                continue
             
+            self.active.add(job.campaign_id)
+            if job.pending is not None:
+                self.paused.pop(job.campaign_id, None)
+            with self.condition:
+                if job.pending is None:
+                    self.finished.append(job)
+                else:
+                    account_sid = job.twilio_client.account_sid
+                    account = self.accounts.get(account_sid)
+                    if account is None:
+                        account = AccountQueue(ACCOUNT_MPS_OVERRIDES.get(account_sid, ACCOUNT_MPS))
+                        self.accounts[account_sid] = account
+                    account.refill(time.monotonic())
+                    account.add(job)
+    
+    def acquire(self):
+        """Block until this process holds the dispatch lock; False if it stops first"""
+        while not self.stopping:
+            try:
+                if storage.acquire_dispatch_lock():
+                    logger.info(f"Process {os.getpid()} is now the campaign dispatcher")
+                    return True
             except Exception as e:
-                cursor.execute('''
-                    INSERT INTO message_status (campaign_id, phone_number, message_sid, status, error_message)
-                    VALUES (?, ?, ?, ?, ?)
-                ''', (campaign_id, phone_number, None, 'failed', str(e)))
+                logger.error(f"Dispatcher failed to take the dispatch lock: {str(e)}")
+            with self.condition:
+                self.condition.wait(DISPATCH_POLL_SECONDS)
+        return False
+    
+    def run(self):
+        if not self.acquire():
+            return
+        self.executor = ThreadPoolExecutor(self.workers, thread_name_prefix='sms-sender')
+        next_poll = 0.0
+        
+        while True:
+            if self.stopping:
+                self.drain()
+                return
+            
+            if self.poll_requested or time.monotonic() >= next_poll:
+                self.poll_requested = False
+                next_poll = time.monotonic() + DISPATCH_POLL_SECONDS
+                self.load_campaigns()
+            
+            with self.condition:
+                if self.stopping:
+                    continue
+                now = time.monotonic()
+                timeout = max(0.0, next_poll - now)
+                for account in self.accounts.values():
+                    if not account.users:
+                        continue
+                    account.refill(now)
+                    while account.users and account.tokens >= 1 and self.in_flight < self.workers:
+                        self.claims.append(account.pick())
+                        self.in_flight += 1
+                    if account.users and account.tokens < 1:
+                        timeout = min(timeout, account.next_token_delay())
                 
-                failed += 1
-                logger.error(f"Unexpected error sending to {phone_number}: {str(e)}")
+                results, finished, claims = [], [], []
+                if now >= self.retry_at:
+                    results, self.results = self.results, []
+                    finished, self.finished = self.finished, []
+                    claims, self.claims = self.claims, []
+                elif self.results or self.finished or self.claims:
+                    delay = self.retry_at - now
+                    timeout = min(timeout, delay)
+                if not claims and not results and not finished:
+                    if not self.poll_requested:
+                        self.condition.wait(timeout)
+                    continue
+            
+            if results or claims:
+                try:
+                    storage.record_results(results, [message[0] for _, message in claims])
+                except Exception as e:
+                    # Nothing of the batch was stored; keep it, the messages
+                    # waiting to be claimed and the jobs it belongs to until a
+                    # retry succeeds
+                    logger.error(f"Dispatcher failed to record {len(results)} results and {len(claims)} "
+                                 f"claims, will retry: {str(e)}")
+                    self.retry_later(results, finished, claims)
+                    continue
+            
+            try:
+                for job, message in claims:
+                    self.executor.submit(self.send, job, message)
+            except RuntimeError:
+                # The interpreter is shutting down; claimed recipients that
+                # were not submitted are sent by the next dispatcher
+                self.stopping = True
+            
+            unfinished = []
+            for job in finished:
+                try:
+                    self.finish(job)
+                    self.active.discard(job.campaign_id)
+                except Exception as e:
+                    logger.error(f"Dispatcher failed to finish campaign {job.campaign_id}, will retry: {str(e)}",
+                                 extra={'campaign_id': job.campaign_id})
+                    unfinished.append(job)
+            
+            if unfinished:
+                self.retry_later([], unfinished)
+            else:
+                self.retry_delay = 0.0
+    
+    def retry_later(self, results, finished, claims=()):
+        """Put back results, claims and finished jobs that could not be stored, with backoff"""
+        with self.condition:
+            self.results[:0] = results
+            self.finished[:0] = finished
+            self.claims[:0] = claims
+            self.retry_delay = min(DISPATCH_RETRY_MAX, max(DISPATCH_RETRY_MIN, self.retry_delay * 2))
+            self.retry_at = time.monotonic() + self.retry_delay
+    
+    def drain(self):
+        """Wait for the sends in flight and store their results before the process exits"""
+        self.executor.shutdown(wait=True)
+        with self.condition:
+            results, self.results = self.results, []
+            finished, self.finished = self.finished, []
         
-        # Update campaign with final results
-        cursor.execute('''
-            UPDATE campaigns 
-            SET successful_sends = ?, failed_sends = ?, status = ?, completed_at = CURRENT_TIMESTAMP
-            WHERE id = ?
-        ''', (successful, failed, 'completed', campaign_id))
+        if results:
+            for attempt in range(3):
+                try:
+                    storage.record_results(results)
+                    break
+                except Exception as e:
+                    logger.error(f"Dispatcher failed to record {len(results)} results at exit: {str(e)}")
+                    time.sleep(DISPATCH_RETRY_MIN)
+            else:
+                # Their recipients stay claimed and are sent again on resume
+                return
         
-        conn.commit()
-        logger.info(f"Campaign {campaign_id} completed: {successful} successful, {failed} failed")
+        for job in finished:
+            try:
+                self.finish(job)
+            except Exception as e:
+                logger.error(f"Dispatcher failed to finish campaign {job.campaign_id} at exit: {str(e)}",
+                             extra={'campaign_id': job.campaign_id})
+    
+    def send(self, job, message):
+        recipient_id, phone_number, body, segments = message
+        sid, status, error = None, 'sent', None
+        try:
+            sid = job.twilio_client.messages.create(
+                from_=job.from_number,
+                body=body,
+                to=phone_number
+            ).sid
+        except TwilioException as e:
+            status, error = 'failed', str(e)
+            logger.error(f"Failed to send SMS to {phone_number}: {error}",
+                         extra={'campaign_id': job.campaign_id, 'phone_number': phone_number})
+        except Exception as e:
+            status, error = 'failed', str(e)
+            logger.error(f"Unexpected error sending to {phone_number}: {error}",
+                         extra={'campaign_id': job.campaign_id, 'phone_number': phone_number})
         
-    except Exception as e:
-        cursor.execute('UPDATE campaigns SET status = ? WHERE id = ?', ('error', campaign_id))
-        conn.commit()
-        logger.error(f"Campaign {campaign_id} failed: {str(e)}")
+        with self.condition:
+            self.in_flight -= 1
+            job.in_flight -= 1
+            if status == 'sent':
+                job.successful += 1
+                job.total_segments += segments
+            else:
+                job.failed += 1
+            self.results.append((job.campaign_id, recipient_id, phone_number, sid, status, error, segments))
+            if job.pending is None and job.in_flight == 0:
+                self.finished.append(job)
+            successful, failed = job.successful, job.failed
+            self.condition.notify()
+        
+        # Success lines are sampled; failures above are always logged
+        if status == 'sent' and (successful == 1 or successful % LOG_SUCCESS_EVERY == 0):
+            logger.info(f"Campaign {job.campaign_id} progress: {successful} sent, {failed} failed",
+                        extra={'campaign_id': job.campaign_id, 'successful': successful, 'failed': failed,
+                               'phone_number': phone_number, 'message_sid': sid})
+    
+    def finish(self, job):
+        if job.stalled:
+            # Leave the campaign in 'sending' and reload it from its pending
+            # recipients after a backoff
+            _, delay = self.paused.get(job.campaign_id, (0.0, 0.0))
+            delay = min(DISPATCH_RETRY_MAX, max(DISPATCH_RETRY_MIN, delay * 2))
+            self.paused[job.campaign_id] = (time.monotonic() + delay, delay)
+            logger.warning(f"Campaign {job.campaign_id} paused, resuming in {delay:.1f}s: {job.stalled}",
+                           extra={'campaign_id': job.campaign_id})
+            return
+        
+        status = 'error' if job.error else 'completed'
+        storage.finish_campaign(job.campaign_id, job.successful, job.failed, job.total_segments, status)
+        
+        if job.error:
+            logger.error(f"Campaign {job.campaign_id} failed: {job.error}", extra={'campaign_id': job.campaign_id})
+        else:
+            logger.info(f"Campaign {job.campaign_id} completed: {job.successful} successful, {job.failed} failed",
+                        extra={'campaign_id': job.campaign_id, 'successful': job.successful,
+                               'failed': job.failed, 'total_segments': job.total_segments})
+
+dispatcher = CampaignDispatcher(DISPATCH_WORKERS)
+atexit.register(dispatcher.stop)
+
+if DISPATCHER_IN_WEB:
+    @app.before_request
+    def start_dispatcher():
+        """Make every web process a dispatcher candidate, so campaigns resume after a restart"""
+        dispatcher.start()
+
+def archive_file(archive_name):
+    """Absolute path of a campaign archive, stored as its file name in ARCHIVE_FOLDER
+    
+    Older databases stored the path as seen from the working directory; only
+    its file name is used, so those archives keep working too.
+    """
+    return os.path.join(app.config['ARCHIVE_FOLDER'], os.path.basename(archive_name))
+
+def recent_messages_file(archive_name):
+    """Path of the side file holding an archive's newest rows"""
+    return archive_file(archive_name).replace('.ndjson.gz', '.recent.json')
+
+def write_recent_messages(archive_name, messages):
+    """Store the newest messages of an archive next to it for the status page"""
+    recent_path = recent_messages_file(archive_name)
+    with open(recent_path + '.tmp', 'w', encoding='utf-8') as recent:
+        json.dump(messages, recent, default=str)
+    os.replace(recent_path + '.tmp', recent_path)
+
+def read_recent_messages(archive_name):
+    """Newest MESSAGE_DISPLAY_LIMIT rows of an archived campaign, newest first
+    
+    Reads the small file written next to the archive; for archives made
+    before those files existed, the archive is scanned once and the file
+    written so later views are cheap.
+    """
+    try:
+        with open(recent_messages_file(archive_name), encoding='utf-8') as recent:
+            return [tuple(row) for row in json.load(recent)][:MESSAGE_DISPLAY_LIMIT]
+    except FileNotFoundError:
+        pass
+    
+    messages = list(deque(read_archived_messages(archive_name), maxlen=MESSAGE_DISPLAY_LIMIT))[::-1]
+    write_recent_messages(archive_name, [row[:5] for row in messages])
+    return [row[:5] for row in messages]
+
+def archive_campaign(campaign_id):
+    """Move a finished campaign's message_status rows into a gzip NDJSON file
+    
+    The file is written and renamed into place before any rows are deleted, so
+    a failure leaves the campaign fully in the database. Summary counts stay in
+    campaigns, and the newest rows are kept in a small side file for display.
+    """
+    archive_name = f'campaign_{campaign_id}.ndjson.gz'
+    archive_path = archive_file(archive_name)
+    temp_path = archive_path + '.tmp'
+    
+    archived = 0
+    recent = deque(maxlen=MESSAGE_DISPLAY_LIMIT)
+    with gzip.open(temp_path, 'wt', encoding='utf-8') as archive:
+        for phone_number, message_sid, status, error_message, sent_at, segments in storage.iter_messages(campaign_id):
+            archive.write(json.dumps({
+                'phone_number': phone_number,
+                'message_sid': message_sid,
+                'status': status,
+                'error_message': error_message,
+                'segments': segments,
+                'sent_at': sent_at
+            }, default=str) + '\n')
+            recent.append((phone_number, message_sid, status, error_message, sent_at))
+            archived += 1
+    os.replace(temp_path, archive_path)
+    write_recent_messages(archive_name, list(recent)[::-1])
     
-    finally:
-        conn.close()
+    storage.mark_campaign_archived(campaign_id, archive_name)
+    return archived
+
+def archive_old_campaigns(days, vacuum_pages=ARCHIVE_VACUUM_PAGES):
+    """Archive finished campaigns completed more than ``days`` days ago
+    
+    Each campaign is committed on its own and followed by an incremental
+    compaction step, so the database shrinks gradually without a long
+    exclusive lock. Returns the number of campaigns archived.
+    """
+    compacting = True
+    os.makedirs(app.config['ARCHIVE_FOLDER'], exist_ok=True)
+    cutoff = (datetime.utcnow() - timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
+    
+    archived_campaigns = 0
+    for campaign_id in storage.list_campaigns_to_archive(cutoff):
+        try:
+            archived = archive_campaign(campaign_id)
+        except Exception as e:
+            logger.error(f"Failed to archive campaign {campaign_id}: {str(e)}", extra={'campaign_id': campaign_id})
+            continue
+        
+        if compacting and not storage.compact(vacuum_pages):
+            compacting = False
+            logger.warning("Database is not set up for incremental vacuum; freed space is reused but the file "
+                           "does not shrink until `flask enable-incremental-vacuum` is run during maintenance")
+        archived_campaigns += 1
+        logger.info(f"Archived campaign {campaign_id}: {archived} messages",
+                    extra={'campaign_id': campaign_id, 'archived_messages': archived})
+    
+    return archived_campaigns
+
+def read_archived_messages(archive_name):
+    """Yield message rows from a campaign archive in the message_status column order"""
+    with gzip.open(archive_file(archive_name), 'rt', encoding='utf-8') as archive:
+        for line in archive:
+            record = json.loads(line)
+            yield (record['phone_number'], record['message_sid'], record['status'],
+                   record['error_message'], record['sent_at'], record['segments'])
+
+def iter_message_rows(campaign_id, archive_name):
+    """Yield a campaign's message rows from the database or its archive"""
+    if archive_name:
+        yield from read_archived_messages(archive_name)
+        return
+    
+    yield from storage.iter_messages(campaign_id)
 
 @app.route('/')
 def index():
@@ -240,13 +797,12 @@ def login():
         username = request.form['username']
         password = request.form['password']
         
-        conn = sqlite3.connect('twilio_sms.db')
-        cursor = conn.cursor()
-        cursor.execute('SELECT id, password_hash FROM users WHERE username = ?', (username,))
-        user = cursor.fetchone()
-        conn.close()
+        user = storage.get_user_by_username(username)
+        
+        with profile_phase('password_hash'):
+            password_ok = bool(user) and check_password_hash(user[1], password)
         
-        if user and check_password_hash(user[1], password):
+        if password_ok:
             session['user_id'] = user[0]
             session['username'] = username
             flash('Login successful!', 'success')
@@ -267,20 +823,8 @@ def logout():
 @login_required
 def dashboard():
     """User dashboard"""
-    conn = sqlite3.connect('twilio_sms.db')
-    cursor = conn.cursor()
-    
     # Get recent campaigns
-    cursor.execute('''
-        SELECT id, name, total_numbers, successful_sends, failed_sends, status, created_at
-        FROM campaigns 
-        WHERE user_id = ?
-        ORDER BY created_at DESC
-        LIMIT 10
-    ''', (session['user_id'],))
-    
-    campaigns = cursor.fetchall()
-    conn.close()
+    campaigns = storage.list_recent_campaigns(session['user_id'], 10)
     
     return render_template('dashboard.html', campaigns=campaigns)
 
@@ -292,27 +836,17 @@ def settings():
         twilio_sid = request.form['twilio_sid']
         twilio_token = request.form['twilio_token']
         
-        conn = sqlite3.connect('twilio_sms.db')
-        cursor = conn.cursor()
-        cursor.execute('''
-            UPDATE users SET twilio_sid = ?, twilio_token = ? WHERE id = ?
-        ''', (twilio_sid, twilio_token, session['user_id']))
-        conn.commit()
-        conn.close()
+        storage.update_twilio_credentials(session['user_id'], twilio_sid, twilio_token)
         
         flash('Twilio credentials updated successfully!', 'success')
         return redirect(url_for('settings'))
     
     # Get current settings
-    conn = sqlite3.connect('twilio_sms.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT username, twilio_sid, twilio_token FROM users WHERE id = ?', (session['user_id'],))
-    result = cursor.fetchone()
-    conn.close()
+    result = storage.get_user(session['user_id'])
     
     current_username = result[0] if result else ''
-    current_sid = result[1] if result else ''
-    current_token = result[2] if result else ''
+    current_sid = result[2] if result else ''
+    current_token = result[3] if result else ''
     
     return render_template('settings.html', 
                          current_username=current_username,
@@ -346,33 +880,25 @@ def change_credentials():
             flash('Username must be at least 3 characters long', 'error')
             return redirect(url_for('change_credentials'))
         
-        conn = sqlite3.connect('twilio_sms.db')
-        cursor = conn.cursor()
-        
         # Verify current password
-        cursor.execute('SELECT password_hash, username FROM users WHERE id = ?', (session['user_id'],))
-        user = cursor.fetchone()
+        user = storage.get_user(session['user_id'])
         
-        if not user or not check_password_hash(user[0], current_password):
-            conn.close()
+        with profile_phase('password_hash'):
+            password_ok = bool(user) and check_password_hash(user[1], current_password)
+        
+        if not password_ok:
             flash('Current password is incorrect', 'error')
             return redirect(url_for('change_credentials'))
         
         # Check if new username already exists (for other users)
-        cursor.execute('SELECT id FROM users WHERE username = ? AND id != ?', (new_username, session['user_id']))
-        if cursor.fetchone():
-            conn.close()
+        if storage.username_taken(new_username, session['user_id']):
             flash('Username already exists. Please choose a different one.', 'error')
             return redirect(url_for('change_credentials'))
         
         # Update username and password
-        new_password_hash = generate_password_hash(new_password)
-        cursor.execute('''
-            UPDATE users SET username = ?, password_hash = ? WHERE id = ?
-        ''', (new_username, new_password_hash, session['user_id']))
-        
-        conn.commit()
-        conn.close()
+        with profile_phase('password_hash'):
+            new_password_hash = generate_password_hash(new_password)
+        storage.update_user_credentials(session['user_id'], new_username, new_password_hash)
         
         # Update session
         session['username'] = new_username
@@ -381,11 +907,7 @@ def change_credentials():
         return redirect(url_for('logout'))
     
     # Get current username for display
-    conn = sqlite3.connect('twilio_sms.db')
-    cursor = conn.cursor()
-    cursor.execute('SELECT username FROM users WHERE id = ?', (session['user_id'],))
-    result = cursor.fetchone()
-    conn.close()
+    result = storage.get_user(session['user_id'])
     
     current_username = result[0] if result else ''
     
@@ -399,6 +921,14 @@ def send_sms():
         campaign_name = request.form['campaign_name']
         message_body = request.form['message_body']
         from_number = request.form['from_number']
+        priority = request.form.get('priority', 'normal')
+        if priority not in PRIORITY_WEIGHTS:
+            priority = 'normal'
+        dry_run = bool(request.form.get('dry_run'))
+        
+        if not dry_run and not request.form.get('confirm_send'):
+            flash('Please confirm that you want to send this message to all numbers', 'error')
+            return redirect(request.url)
         
         # Check if file was uploaded
         if 'phone_file' not in request.files:
@@ -415,16 +945,47 @@ def send_sms():
             timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
             filename = f"{timestamp}_{filename}"
             file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            file.save(file_path)
+            with profile_phase('upload_save'):
+                file.save(file_path)
             
-            # Parse phone numbers
-            phone_numbers = parse_phone_numbers(file_path)
+            # Parse recipients, keeping only the columns the message uses
+            template_fields, _ = compile_message_template(message_body)
+            recipients = parse_recipients(file_path, columns=set(template_fields))
+            try:
+                first_recipient = next(recipients, None)
+            except Exception as e:
+                logger.error(f"Error parsing recipients: {str(e)}")
+                first_recipient = None
             
-            if not phone_numbers:
+            if not first_recipient:
                 flash('No valid phone numbers found in the file', 'error')
                 os.remove(file_path)  # Clean up
                 return redirect(request.url)
             
+            missing_fields = [name for name in template_fields if name not in first_recipient[1]]
+            if missing_fields:
+                flash('Message uses fields missing from the uploaded file (a CSV header row is needed): ' +
+                      ', '.join(f'{{{name}}}' for name in missing_fields) +
+                      '. Write {{ and }} to send literal braces.', 'error')
+                os.remove(file_path)  # Clean up
+                return redirect(request.url)
+            
+            # Dry run: project the campaign against a simulated transport without sending
+            if dry_run:
+                user = storage.get_user(session['user_id'])
+                rate = ACCOUNT_MPS_OVERRIDES.get(user[2], ACCOUNT_MPS) if user and user[2] else ACCOUNT_MPS
+                try:
+                    simulation = simulate_campaign(itertools.chain([first_recipient], recipients), message_body, rate,
+                                                   workers=DISPATCH_WORKERS)
+                except Exception as e:
+                    logger.error(f"Error simulating campaign: {str(e)}")
+                    flash('Could not read the uploaded file', 'error')
+                    return redirect(request.url)
+                finally:
+                    os.remove(file_path)  # Clean up
+                return render_template('send_sms.html', simulation=simulation, campaign_name=campaign_name,
+                                       message_body=message_body, from_number=from_number, priority=priority)
+            
             # Get Twilio client
             twilio_client = get_user_twilio_client(session['user_id'])
             if not twilio_client:
@@ -432,28 +993,24 @@ def send_sms():
                 os.remove(file_path)  # Clean up
                 return redirect(url_for('settings'))
             
-            # Create campaign record
-            conn = sqlite3.connect('twilio_sms.db')
-            cursor = conn.cursor()
-            cursor.execute('''
-                INSERT INTO campaigns (user_id, name, message_body, total_numbers)
-                VALUES (?, ?, ?, ?)
-            ''', (session['user_id'], campaign_name, message_body, len(phone_numbers)))
-            
-            campaign_id = cursor.lastrowid
-            conn.commit()
-            conn.close()
-            
-            # Start async SMS sending
-            thread = Thread(target=send_bulk_sms_async, args=(
-                campaign_id, phone_numbers, message_body, twilio_client, from_number
-            ))
-            thread.start()
+            # Store recipients in chunks while the campaign is pending, then queue it
+            campaign_id = storage.create_campaign(session['user_id'], campaign_name, message_body, priority,
+                                                  from_number)
+            try:
+                store_campaign_recipients(campaign_id, itertools.chain([first_recipient], recipients))
+                total_numbers = storage.start_campaign(campaign_id)
+            except Exception as e:
+                logger.error(f"Error storing recipients: {str(e)}", extra={'campaign_id': campaign_id})
+                storage.delete_campaign(campaign_id)
+                flash('Could not read the uploaded file', 'error')
+                return redirect(request.url)
+            finally:
+                os.remove(file_path)  # Clean up
             
-            # Clean up uploaded file
-            os.remove(file_path)
+            # The dispatcher picks the campaign up from the database and streams its recipients
+            dispatcher.wake()
             
-            flash(f'SMS campaign "{campaign_name}" started! Sending to {len(phone_numbers)} numbers.', 'success')
+            flash(f'SMS campaign "{campaign_name}" started! Sending to {total_numbers} numbers.', 'success')
             return redirect(url_for('campaign_status', campaign_id=campaign_id))
     
     return render_template('send_sms.html')
@@ -462,50 +1019,67 @@ def send_sms():
 @login_required
 def campaign_status(campaign_id):
     """View campaign status"""
-    conn = sqlite3.connect('twilio_sms.db')
-    cursor = conn.cursor()
-    
     # Get campaign details
-    cursor.execute('''
-        SELECT name, message_body, total_numbers, successful_sends, failed_sends, status, created_at, completed_at
-        FROM campaigns 
-        WHERE id = ? AND user_id = ?
-    ''', (campaign_id, session['user_id']))
-    
-    campaign = cursor.fetchone()
+    campaign = storage.get_campaign(campaign_id, session['user_id'])
     
     if not campaign:
         flash('Campaign not found', 'error')
         return redirect(url_for('dashboard'))
     
-    # Get individual message statuses
-    cursor.execute('''
-        SELECT phone_number, message_sid, status, error_message, sent_at
-        FROM message_status
-        WHERE campaign_id = ?
-        ORDER BY sent_at DESC
-    ''', (campaign_id,))
+    # Counts are only written to campaigns at completion; derive them while sending
+    if campaign[5] == 'sending':
+        progress = storage.get_campaign_progress(campaign_id)
+        campaign = campaign[:3] + (progress.get('sent', 0), progress.get('failed', 0)) + campaign[5:]
     
-    messages = cursor.fetchall()
-    conn.close()
+    # Get the most recent individual message statuses
+    if campaign[10]:
+        try:
+            messages = read_recent_messages(campaign[10])
+        except OSError as e:
+            logger.error(f"Cannot read archive for campaign {campaign_id}: {str(e)}")
+            messages = []
+    else:
+        messages = storage.list_recent_messages(campaign_id, MESSAGE_DISPLAY_LIMIT)
     
-    return render_template('campaign_status.html', campaign=campaign, messages=messages, campaign_id=campaign_id)
+    return render_template('campaign_status.html', campaign=campaign, messages=messages, campaign_id=campaign_id,
+                           message_limit=MESSAGE_DISPLAY_LIMIT)
+
+@app.route('/campaign/<int:campaign_id>/export')
+@login_required
+def export_campaign(campaign_id):
+    """Download all message statuses of a campaign as CSV"""
+    result = storage.get_campaign_summary(campaign_id, session['user_id'])
+    
+    if not result:
+        flash('Campaign not found', 'error')
+        return redirect(url_for('dashboard'))
+    
+    def generate():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(['phone_number', 'message_sid', 'status', 'error_message', 'sent_at', 'segments'])
+        for row in iter_message_rows(campaign_id, result[4]):
+            writer.writerow(row)
+            if buffer.tell() > 64 * 1024:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+    
+    return Response(generate(), mimetype='text/csv', headers={
+        'Content-Disposition': f'attachment; filename=campaign_{campaign_id}_messages.csv'
+    })
 
 @app.route('/api/campaign/<int:campaign_id>/status')
 @login_required
 def api_campaign_status(campaign_id):
     """API endpoint for campaign status (for AJAX updates)"""
-    conn = sqlite3.connect('twilio_sms.db')
-    cursor = conn.cursor()
+    result = storage.get_campaign_summary(campaign_id, session['user_id'])
     
-    cursor.execute('''
-        SELECT total_numbers, successful_sends, failed_sends, status
-        FROM campaigns 
-        WHERE id = ? AND user_id = ?
-    ''', (campaign_id, session['user_id']))
-    
-    result = cursor.fetchone()
-    conn.close()
+    # Counts are only written to campaigns at completion; derive them while sending
+    if result and result[3] == 'sending':
+        progress = storage.get_campaign_progress(campaign_id)
+        result = (result[0], progress.get('sent', 0), progress.get('failed', 0), result[3])
     
     if result:
         return jsonify({
@@ -517,6 +1091,48 @@ def api_campaign_status(campaign_id):
     else:
         return jsonify({'error': 'Campaign not found'}), 404
 
+@app.cli.command('archive-campaigns')
+@click.option('--days', default=ARCHIVE_AFTER_DAYS, show_default=True,
+              help='Archive finished campaigns completed more than this many days ago.')
+def archive_campaigns_command(days):
+    """Move old campaigns' message rows into compressed archive files"""
+    archived = archive_old_campaigns(days)
+    click.echo(f'Archived {archived} campaign(s)')
+
+@app.cli.command('enable-incremental-vacuum')
+def enable_incremental_vacuum_command():
+    """Rewrite the database once so archiving can shrink it (stop the app first)"""
+    click.echo('Rewriting the database; this locks it until done...')
+    storage.enable_incremental_vacuum()
+    click.echo('Incremental vacuum enabled')
+
+@app.cli.command('run-dispatcher')
+def run_dispatcher_command():
+    """Send queued campaigns from this process (set DISPATCHER_IN_WEB=false for the web app)"""
+    init_db()
+    dispatcher.start()
+    click.echo(f'Dispatcher started (pid {os.getpid()}); it sends once it holds the dispatch lock')
+    dispatcher.thread.join()
+
+@app.cli.command('simulate-campaign')
+@click.argument('phone_file', type=click.Path(exists=True, dir_okay=False))
+@click.option('--message', required=True, help='Message body, may use {column} placeholders.')
+@click.option('--rate', default=ACCOUNT_MPS, show_default=True, help='Account limit in segments per second.')
+@click.option('--workers', default=DISPATCH_WORKERS, show_default=True, help='Concurrent sender threads.')
+@click.option('--latency', default=SIMULATED_LATENCY, show_default=True, help='Mean API latency in seconds.')
+@click.option('--latency-jitter', default=SIMULATED_LATENCY_JITTER, show_default=True,
+              help='Standard deviation of API latency in seconds.')
+@click.option('--error-rate', default=SIMULATED_ERROR_RATE, show_default=True, help='Share of sends that fail.')
+@click.option('--seed', type=int, default=None, help='Random seed for a reproducible run.')
+def simulate_campaign_command(phone_file, message, rate, workers, latency, latency_jitter, error_rate, seed):
+    """Project duration, throughput and cost of a campaign without sending"""
+    template_fields, _ = compile_message_template(message)
+    report = simulate_campaign(parse_recipients(phone_file, columns=set(template_fields)), message, rate,
+                               workers=workers, latency=latency, latency_jitter=latency_jitter,
+                               error_rate=error_rate, seed=seed)
+    for key, value in report.items():
+        click.echo(f'{key}: {value}')
+
 if __name__ == '__main__':
     init_db()
     # For production, use a proper WSGI server like Gunicorn
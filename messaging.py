@@ -0,0 +1,296 @@
+"""
+GMADP messaging core
+Message templates, SMS segment counting, per-account send pacing and the
+dry-run simulator. Nothing here touches Flask, Twilio or storage, so scripts
+such as tsms.py can import it without starting the app.
+"""
+
+import os
+import re
+import time
+import heapq
+import random
+from collections import Counter
+
+# Message template placeholders look like {name}; write {{ and }} to send literal braces
+TEMPLATE_FIELD_RE = re.compile(r'\{\{|\}\}|\{([A-Za-z_][A-Za-z0-9_]*)\}')
+
+# GSM 03.38 character sets; extension characters cost two septets each
+GSM7_BASIC = frozenset(
+    '@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞÆæßÉ !"#¤%&\'()*+,-./0123456789:;<=>?'
+    '¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§¿abcdefghijklmnopqrstuvwxyzäöñüà'
+)
+GSM7_EXTENDED = frozenset('^{}\\[~]|€\f')
+
+# Dry-run model: simulated Twilio API latency (seconds), its jitter, the share
+# of sends that fail, and the price of one SMS segment used for cost estimates
+SIMULATED_LATENCY = float(os.environ.get('SIMULATED_LATENCY', 0.25))
+SIMULATED_LATENCY_JITTER = float(os.environ.get('SIMULATED_LATENCY_JITTER', 0.05))
+SIMULATED_ERROR_RATE = float(os.environ.get('SIMULATED_ERROR_RATE', 0.0))
+SEGMENT_COST = float(os.environ.get('SEGMENT_COST', 0.0079))
+
+# Relative share of an account's send rate for each campaign priority
+PRIORITY_WEIGHTS = {'normal': 1, 'high': 4, 'urgent': 16}
+
+class TransientError(Exception):
+    """Raised by a job's messages when the next one can be read again later"""
+
+class CampaignJob:
+    """Sending state of one running campaign inside the dispatcher"""
+    
+    def __init__(self, campaign_id, user_id, messages, twilio_client, from_number, priority):
+        self.campaign_id = campaign_id
+        self.user_id = user_id
+        self.messages = messages
+        self.twilio_client = twilio_client
+        self.from_number = from_number
+        self.weight = PRIORITY_WEIGHTS.get(priority, PRIORITY_WEIGHTS['normal'])
+        self.pass_value = 0.0
+        self.pending = None
+        self.in_flight = 0
+        self.error = None
+        self.stalled = None
+        self.successful = 0
+        self.failed = 0
+        self.total_segments = 0
+    
+    def advance(self):
+        """Read the next message ahead so an exhausted job can be retired"""
+        try:
+            self.pending = next(self.messages, None)
+        except TransientError as e:
+            # Retired for now; the campaign itself is not finished
+            self.pending = None
+            self.stalled = str(e)
+        except Exception as e:
+            self.pending = None
+            self.error = str(e)
+
+class AccountQueue:
+    """Token bucket and weighted fair queue for one Twilio account
+    
+    Users are served in proportion to the highest priority weight among their
+    running campaigns, and each user's campaigns in proportion to their own
+    weights (stride scheduling). Newcomers start at the current virtual time,
+    so a small or urgent campaign is interleaved at once instead of waiting
+    behind a large backlog. Tokens are charged per SMS segment.
+    """
+    
+    def __init__(self, rate):
+        self.rate = rate
+        self.capacity = max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.users = {}
+        self.user_pass = {}
+        self.virtual_time = 0.0
+    
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def next_token_delay(self):
+        return max(0.0, (1 - self.tokens) / self.rate)
+    
+    def add(self, job):
+        campaigns = self.users.setdefault(job.user_id, {})
+        if not campaigns:
+            self.user_pass[job.user_id] = self.virtual_time
+        job.pass_value = min((other.pass_value for other in campaigns.values()), default=0.0)
+        campaigns[job.campaign_id] = job
+    
+    def pick(self):
+        """Take the next message from the campaign with the lowest pass value"""
+        if len(self.users) == 1:
+            user_id, campaigns = next(iter(self.users.items()))
+        else:
+            user_id = min(self.users, key=self.user_pass.__getitem__)
+            campaigns = self.users[user_id]
+        if len(campaigns) == 1:
+            job = next(iter(campaigns.values()))
+            user_weight = job.weight
+        else:
+            job = min(campaigns.values(), key=lambda candidate: candidate.pass_value)
+            user_weight = max(candidate.weight for candidate in campaigns.values())
+        message = job.pending
+        cost = message[3]
+        
+        self.virtual_time = self.user_pass[user_id]
+        self.user_pass[user_id] += cost / user_weight
+        job.pass_value += cost / job.weight
+        self.tokens -= cost
+        
+        job.in_flight += 1
+        job.advance()
+        if job.pending is None:
+            del campaigns[job.campaign_id]
+            if not campaigns:
+                del self.users[user_id]
+                del self.user_pass[user_id]
+        return job, message
+
+def normalize_column_name(name):
+    """Normalize a CSV header or template field name for matching"""
+    return '_'.join(name.strip().lower().split())
+
+def measure_text(text):
+    """Return (GSM-7 septets or None if not GSM-encodable, UTF-16 code units)"""
+    units = len(text.encode('utf-16-le')) // 2
+    if GSM7_BASIC.issuperset(text):
+        return len(text), units
+    
+    septets = 0
+    for char in text:
+        if char in GSM7_BASIC:
+            septets += 1
+        elif char in GSM7_EXTENDED:
+            septets += 2
+        else:
+            return None, units
+    return septets, units
+
+def segment_count(septets, units):
+    """Number of SMS segments for a measured message body"""
+    if septets is not None:
+        return 1 if septets <= 160 else -(-septets // 153)
+    return 1 if units <= 70 else -(-units // 67)
+
+def count_sms_segments(text):
+    """Number of SMS segments Twilio will bill for a message body"""
+    return segment_count(*measure_text(text))
+
+def compile_message_template(message_body):
+    """Precompile a message template for per-recipient rendering
+    
+    Returns (field_names, render) where render(fields) gives the message body
+    and its segment count. The literal text is split and measured once here, so
+    each render only joins the recipient's values and measures those.
+    """
+    literals, names = [''], []
+    position = 0
+    for match in TEMPLATE_FIELD_RE.finditer(message_body):
+        literals[-1] += message_body[position:match.start()]
+        if match.group(1) is None:
+            literals[-1] += match.group()[0]
+        else:
+            names.append(normalize_column_name(match.group(1)))
+            literals.append('')
+        position = match.end()
+    literals[-1] += message_body[position:]
+    base_septets, base_units = measure_text(''.join(literals))
+    
+    if not names:
+        text = literals[0]
+        segments = segment_count(base_septets, base_units)
+        
+        def render_static(fields):
+            return text, segments
+        
+        return [], render_static
+    
+    first_literal = literals[0]
+    slots = list(zip(names, literals[1:]))
+    
+    def render(fields):
+        pieces = [first_literal]
+        septets, units = base_septets, base_units
+        for name, literal in slots:
+            value = fields.get(name, '')
+            pieces.append(value)
+            pieces.append(literal)
+            value_septets, value_units = measure_text(value)
+            units += value_units
+            if septets is not None:
+                septets = None if value_septets is None else septets + value_septets
+        return ''.join(pieces), segment_count(septets, units)
+    
+    return list(dict.fromkeys(names)), render
+
+def simulate_campaign(recipients, message_body, rate=None, workers=1, latency=SIMULATED_LATENCY,
+                      latency_jitter=SIMULATED_LATENCY_JITTER, error_rate=SIMULATED_ERROR_RATE,
+                      segment_cost=SEGMENT_COST, send_pause=0.0, seed=None):
+    """Dry-run a campaign against a simulated transport and project its delivery
+    
+    Recipients go through the same de-duplication, template rendering, segment
+    counting and AccountQueue pacing as a real send, but on a virtual clock:
+    each send occupies one of ``workers`` slots for a randomly drawn latency
+    and fails with probability ``error_rate``. Nothing is stored or sent.
+    
+    ``rate`` is the account limit in segments per second, or None for a
+    sender without one. ``send_pause`` keeps a slot idle for that long after
+    each successful send, like a script sleeping between messages.
+    """
+    started = time.perf_counter()
+    rng = random.Random(seed)
+    _, render = compile_message_template(message_body)
+    
+    counts = {'recipients': 0, 'duplicates': 0}
+    seen = set()
+    
+    def unique_messages():
+        for number, fields in recipients:
+            if number in seen:
+                counts['duplicates'] += 1
+                continue
+            seen.add(number)
+            counts['recipients'] += 1
+            body, segments = render(fields)
+            yield None, number, body, segments
+    
+    job = CampaignJob(0, 0, unique_messages(), None, None, 'normal')
+    job.advance()
+    limited = rate is not None
+    account = AccountQueue(rate if limited else 1.0)
+    account.updated = 0.0
+    if job.pending is not None:
+        account.add(job)
+    
+    now = 0.0
+    finish_times = []
+    segments_per_second = Counter()
+    successful = failed = total_segments = sent_segments = max_segments = 0
+    duration = 0.0
+    
+    while account.users or finish_times:
+        while finish_times and finish_times[0] <= now:
+            heapq.heappop(finish_times)
+        
+        account.refill(now)
+        while account.users and (account.tokens >= 1 or not limited) and len(finish_times) < workers:
+            segments = account.pick()[1][3]
+            total_segments += segments
+            max_segments = max(max_segments, segments)
+            segments_per_second[int(now)] += segments
+            finish = now + max(0.0, rng.gauss(latency, latency_jitter))
+            duration = max(duration, finish)
+            if rng.random() < error_rate:
+                failed += 1
+            else:
+                successful += 1
+                sent_segments += segments
+                finish += send_pause
+            heapq.heappush(finish_times, finish)
+        
+        # Jump to whichever comes first: a free sender or the next token
+        next_events = finish_times[:1]
+        if account.users and limited and len(finish_times) < workers:
+            next_events.append(now + account.next_token_delay() + 1e-9)
+        if not next_events:
+            break
+        now = max(now, min(next_events))
+    
+    return {
+        'recipients': counts['recipients'],
+        'duplicates': counts['duplicates'],
+        'successful': successful,
+        'failed': failed,
+        'total_segments': total_segments,
+        'max_segments': max_segments,
+        'estimated_cost': round(sent_segments * segment_cost, 2),
+        'duration_seconds': round(duration, 1),
+        'average_mps': round(total_segments / max(duration, 1.0), 2),
+        'peak_mps': max(segments_per_second.values(), default=0),
+        'rate_limit': rate,
+        'simulation_seconds': round(time.perf_counter() - started, 2)
+    }
+
@@ -0,0 +1,149 @@
+"""
+GMADP request profiling
+Opt-in per-request timing broken down by phase (database, template rendering,
+upload parsing, password hashing), slow request/query logging and sampled
+cProfile dumps. Nothing is registered unless init_profiling() is called.
+"""
+
+import os
+import time
+import random
+import logging
+import cProfile
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+
+from flask import g, request, session, has_request_context, before_render_template, template_rendered
+
+logger = logging.getLogger(__name__)
+
+# Set by init_profiling(); while False the helpers below cost next to nothing
+enabled = False
+settings = {}
+
+def init_profiling(app, storage, slow_request_ms=500, slow_query_ms=100, profile_routes=(),
+                   profile_sample_rate=0.0, profile_folder='profiles', profile_users=('admin',), max_profiles=100):
+    """Install the profiling hooks on a Flask app and its storage backend
+
+    Requests slower than ``slow_request_ms`` are logged with their phase
+    breakdown, and queries slower than ``slow_query_ms`` are logged with their
+    SQL. Requests to endpoints in ``profile_routes`` are run under cProfile
+    with probability ``profile_sample_rate``; users named in ``profile_users``
+    can also force it with ?profile=1. Dumps go to ``profile_folder``, which
+    keeps only the newest ``max_profiles`` of them.
+    """
+    global enabled
+    enabled = True
+    settings.update(slow_request=slow_request_ms / 1000.0, slow_query=slow_query_ms / 1000.0,
+                    profile_routes=frozenset(profile_routes), profile_sample_rate=profile_sample_rate,
+                    profile_folder=profile_folder, profile_users=frozenset(profile_users),
+                    max_profiles=max_profiles)
+    os.makedirs(profile_folder, exist_ok=True)
+
+    storage.on_query = record_query
+    app.before_request(start_request)
+    app.after_request(finish_request)
+    app.teardown_request(stop_profiler)
+    before_render_template.connect(start_render, app)
+    template_rendered.connect(finish_render, app)
+
+def add_phase(name, elapsed):
+    phases = g.profile['phases']
+    phases[name] = phases.get(name, 0.0) + elapsed
+
+@contextmanager
+def timed_phase(name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        if has_request_context() and 'profile' in g:
+            add_phase(name, time.perf_counter() - started)
+
+def profile_phase(name):
+    """Context manager that adds its duration to the current request's phase ``name``"""
+    return timed_phase(name) if enabled else nullcontext()
+
+def record_query(query, elapsed, rows):
+    """Storage hook called after every query with its duration and row count (None if unknown)"""
+    sql = ' '.join(query.split())
+    if has_request_context() and 'profile' in g:
+        add_phase('db', elapsed)
+        g.profile['queries'].append((sql, elapsed, rows))
+    if elapsed >= settings['slow_query']:
+        row_note = '' if rows is None else f', {rows} rows'
+        logger.warning(f"Slow query ({elapsed * 1000:.1f} ms{row_note}): {sql}",
+                       extra={'duration_ms': round(elapsed * 1000, 1), 'rows': rows, 'sql': sql})
+
+def start_render(sender, template, context, **extra):
+    g.profile['render_started'] = time.perf_counter()
+
+def finish_render(sender, template, context, **extra):
+    started = g.profile.pop('render_started', None)
+    if started is not None:
+        add_phase('template', time.perf_counter() - started)
+
+def start_request():
+    g.profile = {'started': time.perf_counter(), 'phases': {}, 'queries': []}
+
+    forced = (request.args.get('profile') == '1' and 'user_id' in session and
+              session.get('username') in settings['profile_users'])
+    sampled = (request.endpoint in settings['profile_routes'] and
+               random.random() < settings['profile_sample_rate'])
+    if forced or sampled:
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Another profiler is already active in this process
+            return
+        g.profile['profiler'] = profiler
+
+def finish_request(response):
+    profile = g.get('profile')
+    if profile is None:
+        return response
+
+    total = time.perf_counter() - profile['started']
+    phases = profile['phases']
+    timings = [f'{name};dur={elapsed * 1000:.1f}' for name, elapsed in phases.items()]
+    timings.append(f'total;dur={total * 1000:.1f}')
+    response.headers['Server-Timing'] = ', '.join(timings)
+
+    if total >= settings['slow_request']:
+        breakdown = ', '.join(f'{name} {elapsed * 1000:.1f} ms' for name, elapsed in phases.items())
+        slowest = sorted(profile['queries'], key=lambda item: item[1], reverse=True)[:5]
+        logger.warning(f"Slow request {request.method} {request.path} ({total * 1000:.1f} ms): {breakdown or 'no phases'}",
+                       extra={'endpoint': request.endpoint, 'status_code': response.status_code,
+                              'duration_ms': round(total * 1000, 1),
+                              'phases_ms': {name: round(elapsed * 1000, 1) for name, elapsed in phases.items()},
+                              'query_count': len(profile['queries']),
+                              'slowest_queries': [{'sql': sql, 'duration_ms': round(elapsed * 1000, 1), 'rows': rows}
+                                                  for sql, elapsed, rows in slowest]})
+    return response
+
+def stop_profiler(exc):
+    profile = g.get('profile')
+    profiler = profile.pop('profiler', None) if profile else None
+    if profiler is None:
+        return
+
+    profiler.disable()
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S_%f')
+    dump_path = os.path.join(settings['profile_folder'], f'{request.endpoint}_{timestamp}_{os.getpid()}.prof')
+    profiler.dump_stats(dump_path)
+    logger.info(f"Saved profile of {request.method} {request.path} to {dump_path}",
+                extra={'endpoint': request.endpoint, 'profile_path': dump_path})
+    prune_profiles()
+
+def prune_profiles():
+    """Delete the oldest dumps beyond the configured maximum"""
+    folder = settings['profile_folder']
+    dumps = sorted((entry for entry in os.scandir(folder) if entry.name.endswith('.prof')),
+                   key=lambda entry: entry.stat().st_mtime)
+    for entry in dumps[:max(0, len(dumps) - settings['max_profiles'])]:
+        try:
+            os.remove(entry.path)
+        except OSError:
+            # Removed concurrently by another worker
+            pass
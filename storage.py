@@ -0,0 +1,585 @@
+"""
+GMADP storage backends
+All persistent state (users, campaigns, recipients, message status) goes through
+one of these classes. SQLite is the default and serves a single host; with a
+PostgreSQL server several app nodes share campaign state, and the dispatch lock
+keeps sending to one process across all of them.
+"""
+
+import os
+import time
+import sqlite3
+import threading
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+try:
+    import fcntl
+except ImportError:  # Windows; the dispatch lock is then a no-op
+    fcntl = None
+
+# PostgreSQL advisory lock id held by the single campaign dispatcher
+DISPATCH_LOCK_KEY = 0x474D414450
+
+class SQLiteStorage:
+    """Campaign state in a local SQLite database file"""
+
+    placeholder = '?'
+    id_column = 'INTEGER PRIMARY KEY AUTOINCREMENT'
+    insert_ignore = 'INSERT OR IGNORE INTO'
+    on_conflict_ignore = ''
+
+    # Optional callable(query, elapsed_seconds, rows) run after each query;
+    # rows is None when the driver does not know the count (e.g. a SELECT
+    # whose rows are fetched later)
+    on_query = None
+
+    def __init__(self, path='twilio_sms.db'):
+        self.path = path
+
+    def connect(self):
+        return sqlite3.connect(self.path)
+
+    def release(self, conn):
+        conn.close()
+
+    @contextmanager
+    def cursor(self):
+        """Cursor on a connection that is committed on success and released afterwards"""
+        conn = self.connect()
+        try:
+            yield conn.cursor()
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self.release(conn)
+
+    def sql(self, query):
+        """Adapt a query written with ? placeholders to this backend"""
+        return query if self.placeholder == '?' else query.replace('?', self.placeholder)
+
+    def report_query(self, query, started, rows):
+        if self.on_query is not None:
+            self.on_query(query, time.perf_counter() - started, rows)
+
+    def execute(self, cursor, query, params=()):
+        started = time.perf_counter()
+        cursor.execute(self.sql(query), params)
+        self.report_query(query, started, cursor.rowcount if cursor.rowcount >= 0 else None)
+
+    def executemany(self, cursor, query, rows):
+        started = time.perf_counter()
+        cursor.executemany(self.sql(query), rows)
+        self.report_query(query, started, cursor.rowcount)
+
+    def fetchone(self, query, params=()):
+        with self.cursor() as cursor:
+            started = time.perf_counter()
+            cursor.execute(self.sql(query), params)
+            row = cursor.fetchone()
+            self.report_query(query, started, int(row is not None))
+            return row
+
+    def fetchall(self, query, params=()):
+        with self.cursor() as cursor:
+            started = time.perf_counter()
+            cursor.execute(self.sql(query), params)
+            rows = cursor.fetchall()
+            self.report_query(query, started, len(rows))
+            return rows
+
+    # Schema
+
+    def init_schema(self):
+        """Create tables and indexes, and add columns missing from older databases"""
+        with self.cursor() as cursor:
+            self.prepare(cursor)
+
+            # Users table
+            self.execute(cursor, f'''
+                CREATE TABLE IF NOT EXISTS users (
+                    id {self.id_column},
+                    username TEXT UNIQUE NOT NULL,
+                    password_hash TEXT NOT NULL,
+                    twilio_sid TEXT,
+                    twilio_token TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+
+            # SMS campaigns table
+            self.execute(cursor, f'''
+                CREATE TABLE IF NOT EXISTS campaigns (
+                    id {self.id_column},
+                    user_id INTEGER,
+                    name TEXT NOT NULL,
+                    message_body TEXT NOT NULL,
+                    total_numbers INTEGER,
+                    successful_sends INTEGER DEFAULT 0,
+                    failed_sends INTEGER DEFAULT 0,
+                    total_segments INTEGER DEFAULT 0,
+                    priority TEXT DEFAULT 'normal',
+                    from_number TEXT,
+                    status TEXT DEFAULT 'pending',
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    completed_at TIMESTAMP,
+                    archived_at TIMESTAMP,
+                    archive_path TEXT,
+                    FOREIGN KEY (user_id) REFERENCES users (id)
+                )
+            ''')
+
+            # Individual message status table
+            self.execute(cursor, f'''
+                CREATE TABLE IF NOT EXISTS message_status (
+                    id {self.id_column},
+                    campaign_id INTEGER,
+                    phone_number TEXT,
+                    message_sid TEXT,
+                    status TEXT,
+                    error_message TEXT,
+                    segments INTEGER,
+                    sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    FOREIGN KEY (campaign_id) REFERENCES campaigns (id)
+                )
+            ''')
+
+            # Recipients of each campaign and their delivery state
+            self.execute(cursor, f'''
+                CREATE TABLE IF NOT EXISTS campaign_recipients (
+                    id {self.id_column},
+                    campaign_id INTEGER NOT NULL,
+                    phone_number TEXT NOT NULL,
+                    fields TEXT,
+                    status TEXT DEFAULT 'pending',
+                    FOREIGN KEY (campaign_id) REFERENCES campaigns (id)
+                )
+            ''')
+            self.execute(cursor, '''
+                CREATE UNIQUE INDEX IF NOT EXISTS idx_campaign_recipients_number
+                ON campaign_recipients (campaign_id, phone_number)
+            ''')
+            self.execute(cursor, '''
+                CREATE INDEX IF NOT EXISTS idx_campaign_recipients_status
+                ON campaign_recipients (campaign_id, status, id)
+            ''')
+            self.execute(cursor, '''
+                CREATE INDEX IF NOT EXISTS idx_message_status_campaign
+                ON message_status (campaign_id, sent_at)
+            ''')
+            self.execute(cursor, '''
+                CREATE INDEX IF NOT EXISTS idx_message_status_campaign_id
+                ON message_status (campaign_id, id)
+            ''')
+
+            # Add columns introduced after the first release to existing databases
+            self.ensure_column(cursor, 'campaigns', 'total_segments', 'INTEGER DEFAULT 0')
+            self.ensure_column(cursor, 'message_status', 'segments', 'INTEGER')
+            self.ensure_column(cursor, 'campaigns', 'priority', "TEXT DEFAULT 'normal'")
+            self.ensure_column(cursor, 'campaigns', 'archived_at', 'TIMESTAMP')
+            self.ensure_column(cursor, 'campaigns', 'archive_path', 'TEXT')
+            self.ensure_column(cursor, 'campaigns', 'from_number', 'TEXT')
+
+    def prepare(self, cursor):
+        """Backend settings applied before the tables are created"""
+        # Only takes effect on a new, empty database; existing databases are
+        # converted by `flask enable-incremental-vacuum`
+        cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+
+    def ensure_column(self, cursor, table, column, definition):
+        """Add a column to an existing table if it is missing"""
+        cursor.execute(f'PRAGMA table_info({table})')
+        if column not in [row[1] for row in cursor.fetchall()]:
+            cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+    def compact(self, pages):
+        """Return up to ``pages`` free pages to the filesystem
+
+        Needs auto_vacuum=INCREMENTAL; returns False without doing anything on
+        a database that has not been converted yet.
+        """
+        conn = self.connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('PRAGMA auto_vacuum')
+            if cursor.fetchone()[0] != 2:
+                return False
+            cursor.execute(f'PRAGMA incremental_vacuum({int(pages)})')
+            cursor.fetchall()
+            conn.commit()
+            return True
+        finally:
+            self.release(conn)
+
+    def enable_incremental_vacuum(self):
+        """Switch an existing database to auto_vacuum=INCREMENTAL
+
+        This rewrites the whole file with VACUUM, holding an exclusive lock
+        until it is done, so it is a maintenance step to run while the app is
+        stopped.
+        """
+        conn = self.connect()
+        try:
+            conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            conn.execute('VACUUM')
+        finally:
+            self.release(conn)
+
+    def insert_returning_id(self, cursor, query, params):
+        self.execute(cursor, query, params)
+        return cursor.lastrowid
+
+    def acquire_dispatch_lock(self):
+        """Try to become the only campaign dispatcher for this database
+
+        Returns True once this process holds the lock, which it keeps until it
+        exits. Processes on the same host share an SQLite file, so an exclusive
+        lock on a file next to it is enough.
+        """
+        if fcntl is None:
+            return True
+        lock_file = open(self.path + '.dispatch.lock', 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self.dispatch_lock = lock_file
+        return True
+
+    # Users
+
+    def get_user_by_username(self, username):
+        """Return (id, password_hash) for a username, or None"""
+        return self.fetchone('SELECT id, password_hash FROM users WHERE username = ?', (username,))
+
+    def get_user(self, user_id):
+        """Return (username, password_hash, twilio_sid, twilio_token), or None"""
+        return self.fetchone('''
+            SELECT username, password_hash, twilio_sid, twilio_token FROM users WHERE id = ?
+        ''', (user_id,))
+
+    def create_user(self, username, password_hash):
+        with self.cursor() as cursor:
+            self.execute(cursor, 'INSERT INTO users (username, password_hash) VALUES (?, ?)',
+                         (username, password_hash))
+
+    def username_taken(self, username, exclude_user_id):
+        return self.fetchone('SELECT id FROM users WHERE username = ? AND id != ?',
+                             (username, exclude_user_id)) is not None
+
+    def update_user_credentials(self, user_id, username, password_hash):
+        with self.cursor() as cursor:
+            self.execute(cursor, 'UPDATE users SET username = ?, password_hash = ? WHERE id = ?',
+                         (username, password_hash, user_id))
+
+    def update_twilio_credentials(self, user_id, twilio_sid, twilio_token):
+        with self.cursor() as cursor:
+            self.execute(cursor, 'UPDATE users SET twilio_sid = ?, twilio_token = ? WHERE id = ?',
+                         (twilio_sid, twilio_token, user_id))
+
+    # Campaigns
+
+    def create_campaign(self, user_id, name, message_body, priority, from_number):
+        """Create a campaign in 'pending' state, before its recipients are stored"""
+        with self.cursor() as cursor:
+            return self.insert_returning_id(cursor, '''
+                INSERT INTO campaigns (user_id, name, message_body, total_numbers, priority, from_number, status)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', (user_id, name, message_body, 0, priority, from_number, 'pending'))
+
+    def add_recipients(self, campaign_id, recipients):
+        """Store a chunk of (phone_number, fields_json) recipients in its own transaction
+
+        Numbers already stored for the campaign are ignored.
+        """
+        with self.cursor() as cursor:
+            self.executemany(cursor, f'''
+                {self.insert_ignore} campaign_recipients (campaign_id, phone_number, fields)
+                VALUES (?, ?, ?) {self.on_conflict_ignore}
+            ''', [(campaign_id, number, fields) for number, fields in recipients])
+
+    def start_campaign(self, campaign_id):
+        """Count a pending campaign's recipients and queue it for sending; returns the count"""
+        with self.cursor() as cursor:
+            self.execute(cursor, 'SELECT COUNT(*) FROM campaign_recipients WHERE campaign_id = ?', (campaign_id,))
+            total_numbers = cursor.fetchone()[0]
+            self.execute(cursor, '''
+                UPDATE campaigns SET total_numbers = ?, status = 'sending' WHERE id = ?
+            ''', (total_numbers, campaign_id))
+        return total_numbers
+
+    def delete_campaign(self, campaign_id):
+        """Remove a campaign and everything stored for it, e.g. after a failed upload"""
+        with self.cursor() as cursor:
+            self.execute(cursor, 'DELETE FROM message_status WHERE campaign_id = ?', (campaign_id,))
+            self.execute(cursor, 'DELETE FROM campaign_recipients WHERE campaign_id = ?', (campaign_id,))
+            self.execute(cursor, 'DELETE FROM campaigns WHERE id = ?', (campaign_id,))
+
+    def list_recent_campaigns(self, user_id, limit):
+        return self.fetchall('''
+            SELECT id, name, total_numbers, successful_sends, failed_sends, status, created_at
+            FROM campaigns
+            WHERE user_id = ?
+            ORDER BY created_at DESC
+            LIMIT ?
+        ''', (user_id, limit))
+
+    def get_campaign(self, campaign_id, user_id):
+        return self.fetchone('''
+            SELECT name, message_body, total_numbers, successful_sends, failed_sends, status, created_at, completed_at,
+                   total_segments, archived_at, archive_path
+            FROM campaigns
+            WHERE id = ? AND user_id = ?
+        ''', (campaign_id, user_id))
+
+    def get_campaign_summary(self, campaign_id, user_id):
+        return self.fetchone('''
+            SELECT total_numbers, successful_sends, failed_sends, status, archive_path
+            FROM campaigns
+            WHERE id = ? AND user_id = ?
+        ''', (campaign_id, user_id))
+
+    def list_sending_campaigns(self):
+        """(id, user_id, message_body, priority, from_number) of every campaign waiting to be sent"""
+        return self.fetchall('''
+            SELECT id, user_id, message_body, priority, from_number
+            FROM campaigns
+            WHERE status = 'sending'
+            ORDER BY id
+        ''')
+
+    def finish_campaign(self, campaign_id, successful, failed, total_segments, status):
+        with self.cursor() as cursor:
+            self.execute(cursor, '''
+                UPDATE campaigns
+                SET successful_sends = ?, failed_sends = ?, total_segments = ?, status = ?,
+                    completed_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+            ''', (successful, failed, total_segments, status, campaign_id))
+
+    def list_campaigns_to_archive(self, cutoff):
+        """Ids of finished, unarchived campaigns completed before ``cutoff``"""
+        return [row[0] for row in self.fetchall('''
+            SELECT id FROM campaigns
+            WHERE status IN ('completed', 'error') AND archived_at IS NULL AND completed_at < ?
+            ORDER BY id
+        ''', (cutoff,))]
+
+    def mark_campaign_archived(self, campaign_id, archive_path):
+        """Drop a campaign's per-message rows once they are safely archived"""
+        with self.cursor() as cursor:
+            self.execute(cursor, 'DELETE FROM message_status WHERE campaign_id = ?', (campaign_id,))
+            self.execute(cursor, 'DELETE FROM campaign_recipients WHERE campaign_id = ?', (campaign_id,))
+            self.execute(cursor, '''
+                UPDATE campaigns SET archived_at = CURRENT_TIMESTAMP, archive_path = ? WHERE id = ?
+            ''', (archive_path, campaign_id))
+
+    # Recipients
+
+    def fetch_pending_recipients(self, campaign_id, after_id, limit):
+        """Next chunk of (id, phone_number, fields_json) pending rows after ``after_id``"""
+        return self.fetchall('''
+            SELECT id, phone_number, fields
+            FROM campaign_recipients
+            WHERE campaign_id = ? AND status = 'pending' AND id > ?
+            ORDER BY id
+            LIMIT ?
+        ''', (campaign_id, after_id, limit))
+
+    def release_claimed_recipients(self, campaign_id):
+        """Return recipients claimed by a dispatcher that stopped before storing their result to pending"""
+        with self.cursor() as cursor:
+            self.execute(cursor, '''
+                UPDATE campaign_recipients SET status = 'pending'
+                WHERE campaign_id = ? AND status = 'claimed'
+            ''', (campaign_id,))
+            return cursor.rowcount
+
+    def get_campaign_progress(self, campaign_id):
+        """Count a campaign's recipients by state"""
+        return dict(self.fetchall('''
+            SELECT status, COUNT(*) FROM campaign_recipients
+            WHERE campaign_id = ?
+            GROUP BY status
+        ''', (campaign_id,)))
+
+    # Message status
+
+    def record_results(self, results, claimed=()):
+        """Store send results as (campaign_id, recipient_id, phone_number, sid, status, error, segments)
+
+        Recipients in ``claimed`` are marked as handed to a sender in the same
+        transaction.
+        """
+        with self.cursor() as cursor:
+            if claimed:
+                self.executemany(cursor, '''
+                    UPDATE campaign_recipients SET status = 'claimed' WHERE id = ?
+                ''', [(recipient_id,) for recipient_id in claimed])
+            self.executemany(cursor, '''
+                INSERT INTO message_status (campaign_id, phone_number, message_sid, status, error_message, segments)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', [row[:1] + row[2:] for row in results])
+            self.executemany(cursor, '''
+                UPDATE campaign_recipients SET status = ? WHERE id = ?
+            ''', [(row[4], row[1]) for row in results])
+
+    def get_message_totals(self, campaign_id):
+        """Return (successful, failed, sent_segments) from a campaign's stored results"""
+        row = self.fetchone('''
+            SELECT COALESCE(SUM(CASE WHEN status = 'sent' THEN 1 ELSE 0 END), 0),
+                   COALESCE(SUM(CASE WHEN status = 'sent' THEN 0 ELSE 1 END), 0),
+                   COALESCE(SUM(CASE WHEN status = 'sent' THEN segments ELSE 0 END), 0)
+            FROM message_status
+            WHERE campaign_id = ?
+        ''', (campaign_id,))
+        return tuple(row)
+
+    def list_recent_messages(self, campaign_id, limit):
+        return self.fetchall('''
+            SELECT phone_number, message_sid, status, error_message, sent_at
+            FROM message_status
+            WHERE campaign_id = ?
+            ORDER BY sent_at DESC
+            LIMIT ?
+        ''', (campaign_id, limit))
+
+    def iter_messages(self, campaign_id, batch_size=1000):
+        """Yield (phone_number, message_sid, status, error_message, sent_at, segments) in send order
+
+        Rows are read in id-ordered pages, each a separate short query, so a
+        slow consumer such as a CSV download never holds the read lock that
+        would block every writer.
+        """
+        last_id = 0
+        while True:
+            rows = self.fetchall('''
+                SELECT id, phone_number, message_sid, status, error_message, sent_at, segments
+                FROM message_status
+                WHERE campaign_id = ? AND id > ?
+                ORDER BY id
+                LIMIT ?
+            ''', (campaign_id, last_id, batch_size))
+            if not rows:
+                return
+            for row in rows:
+                yield row[1:]
+            last_id = rows[-1][0]
+
+class PostgresStorage(SQLiteStorage):
+    """Campaign state on a PostgreSQL server, shared by every app node
+
+    Requires psycopg2 (pip install psycopg2-binary). Connections come from a
+    thread-safe pool sized by DATABASE_POOL_SIZE, created on first use in each
+    process: gunicorn's preload_app imports the app in the master, and a
+    forked worker must not reuse the master's sockets. `python test_setup.py`
+    runs a storage round trip against the configured server.
+    """
+
+    placeholder = '%s'
+    id_column = 'SERIAL PRIMARY KEY'
+    insert_ignore = 'INSERT INTO'
+    on_conflict_ignore = 'ON CONFLICT DO NOTHING'
+
+    def __init__(self, url, pool_size=10):
+        try:
+            import psycopg2.extras
+            import psycopg2.pool
+        except ImportError:
+            raise RuntimeError('DATABASE_URL points at PostgreSQL but psycopg2 is not installed '
+                               '(pip install psycopg2-binary)')
+        self.url = url
+        self.psycopg2 = psycopg2
+        self.extras = psycopg2.extras
+        self.pool_size = pool_size
+        self.pool = None
+        self.pool_pid = None
+        self.pool_lock = threading.Lock()
+        self.inherited_pools = []
+
+    def connect(self):
+        if self.pool_pid != os.getpid():
+            with self.pool_lock:
+                if self.pool_pid != os.getpid():
+                    if self.pool is not None:
+                        # The parent's connections must never be closed from
+                        # here, which would end its sessions; keep them alive
+                        self.inherited_pools.append(self.pool)
+                    self.pool = self.psycopg2.pool.ThreadedConnectionPool(1, self.pool_size, self.url)
+                    self.pool_pid = os.getpid()
+        return self.pool.getconn()
+
+    def release(self, conn):
+        self.pool.putconn(conn)
+
+    def executemany(self, cursor, query, rows):
+        # psycopg2's executemany runs one round trip per row
+        started = time.perf_counter()
+        self.extras.execute_batch(cursor, self.sql(query), rows, page_size=500)
+        # rowcount only covers the last page of the batch
+        self.report_query(query, started, None)
+
+    def ensure_column(self, cursor, table, column, definition):
+        cursor.execute(f'ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column} {definition}')
+
+    def acquire_dispatch_lock(self):
+        # A session-level advisory lock on a dedicated connection, so exactly
+        # one process across all nodes dispatches; it is released when that
+        # process (and with it the connection) goes away
+        conn = self.psycopg2.connect(self.url)
+        conn.autocommit = True
+        with conn.cursor() as cursor:
+            cursor.execute('SELECT pg_try_advisory_lock(%s)', (DISPATCH_LOCK_KEY,))
+            acquired = cursor.fetchone()[0]
+        if not acquired:
+            conn.close()
+            return False
+        self.dispatch_lock = conn
+        return True
+
+    def prepare(self, cursor):
+        pass
+
+    def compact(self, pages):
+        # Autovacuum reclaims space from deleted rows in the background
+        return True
+
+    def enable_incremental_vacuum(self):
+        pass
+
+    def insert_returning_id(self, cursor, query, params):
+        self.execute(cursor, query.rstrip() + ' RETURNING id', params)
+        return cursor.fetchone()[0]
+
+    def iter_messages(self, campaign_id, batch_size=1000):
+        # A named (server-side) cursor streams rows instead of loading them all
+        conn = self.connect()
+        try:
+            with conn.cursor(name=f'messages_{campaign_id}') as cursor:
+                cursor.itersize = batch_size
+                cursor.execute(self.sql('''
+                    SELECT phone_number, message_sid, status, error_message, sent_at, segments
+                    FROM message_status
+                    WHERE campaign_id = ?
+                    ORDER BY id
+                '''), (campaign_id,))
+                yield from cursor
+            conn.commit()
+        finally:
+            self.release(conn)
+
+def create_storage(database_url, pool_size=10):
+    """Build the storage backend for a DATABASE_URL
+
+    sqlite:///relative/path.db and sqlite:////absolute/path.db select SQLite;
+    postgresql:// (or postgres://) URLs select PostgreSQL.
+    """
+    scheme = urlparse(database_url).scheme
+    if scheme == 'sqlite':
+        return SQLiteStorage(database_url[len('sqlite:///'):] or 'twilio_sms.db')
+    if scheme in ('postgres', 'postgresql'):
+        return PostgresStorage(database_url, pool_size)
+    raise ValueError(f'Unsupported DATABASE_URL scheme: {scheme}')
@@ -8,7 +8,6 @@ Run this script to verify the application setup
 import sys
 import os
 import subprocess
-import sqlite3
 
 def test_python_version():
     """Test Python version compatibility"""
@@ -47,11 +46,8 @@ def test_database():
         print("✅ Database initialization successful")
         
         # Test database connection
-        conn = sqlite3.connect('twilio_sms.db')
-        cursor = conn.cursor()
-        cursor.execute("SELECT COUNT(*) FROM users")
-        user_count = cursor.fetchone()[0]
-        conn.close()
+        from app import storage
+        user_count = storage.fetchone("SELECT COUNT(*) FROM users")[0]
         
         print(f"✅ Database connected, {user_count} users found")
         return True
@@ -59,6 +55,41 @@ def test_database():
         print(f"❌ Database error: {str(e)}")
         return False
 
+def test_storage_backend():
+    """Test a campaign round trip on the configured DATABASE_URL (SQLite or PostgreSQL)"""
+    try:
+        from app import storage
+        print(f"Storage backend: {type(storage).__name__}")
+        
+        user_id = storage.get_user_by_username('admin')[0]
+        campaign_id = storage.create_campaign(user_id, 'setup check', 'Hello {name}', 'normal', '+10000000000')
+        try:
+            storage.add_recipients(campaign_id, [('+10000000001', '{"name": "A"}'), ('+10000000002', None)])
+            storage.add_recipients(campaign_id, [('+10000000001', None)])
+            if storage.start_campaign(campaign_id) != 2:
+                print("❌ Duplicate recipients were not ignored")
+                return False
+            
+            pending = storage.fetch_pending_recipients(campaign_id, 0, 10)
+            storage.record_results([(campaign_id, pending[0][0], pending[0][1], 'SM1', 'sent', None, 2),
+                                    (campaign_id, pending[1][0], pending[1][1], None, 'failed', 'error', 1)])
+            if tuple(storage.get_message_totals(campaign_id)) != (1, 1, 2):
+                print("❌ Stored results do not add up")
+                return False
+            if storage.fetch_pending_recipients(campaign_id, 0, 10):
+                print("❌ Recipients still pending after recording results")
+                return False
+            if len(list(storage.iter_messages(campaign_id))) != 2:
+                print("❌ Message rows could not be read back")
+                return False
+            print("✅ Campaign, recipients and results stored and read back")
+        finally:
+            storage.delete_campaign(campaign_id)
+        return True
+    except Exception as e:
+        print(f"❌ Storage error: {str(e)}")
+        return False
+
 def test_app_import():
     """Test if the Flask app can be imported"""
     try:
@@ -118,6 +149,7 @@ def main():
         ("Directory Structure", test_directories),
         ("Configuration Files", test_configuration_files),
         ("Database", test_database),
+        ("Storage Backend", test_storage_backend),
         ("Flask Application", test_app_import),
     ]
     
@@ -5,7 +5,6 @@ import sys
 
 account_sid = ''
 auth_token = ''
-client = Client(account_sid, auth_token)
 
 def read_phone_numbers_from_file(file_path):
     """
@@ -100,6 +99,20 @@ print(f"\n📱 Phone numbers to send SMS:")
 for i, num in enumerate(number_list, 1):
     print(f"   {i}. {num}")
 
+# Dry run: project duration and cost without sending (python tsms.py --dry-run)
+if '--dry-run' in sys.argv:
+    from messaging import simulate_campaign
+    
+    # This script sends one message at a time and sleeps 1 second after each
+    # successful send; it has no per-segment rate limit
+    report = simulate_campaign(((num, {}) for num in number_list), sms_body, workers=1, send_pause=1)
+    print("\n🧪 Dry run (nothing was sent):")
+    print(f"   Recipients: {report['recipients']}")
+    print(f"   SMS segments: {report['total_segments']}")
+    print(f"   Estimated cost: ${report['estimated_cost']:.2f}")
+    print(f"   Projected duration: {report['duration_seconds'] / 60:.1f} minutes")
+    sys.exit(0)
+
 # Confirmation before sending
 print(f"\n📨 Ready to send SMS to {len(number_list)} numbers")
 confirm = input("Do you want to proceed? (yes/y to confirm): ").strip().lower()
@@ -111,6 +124,8 @@ if confirm not in ['yes', 'y']:
 print(f"Sending SMS to {len(number_list)} numbers...")
 print("=" * 50)
 
+client = Client(account_sid, auth_token)
+
 successful_sends = 0
 failed_sends = 0
 